@@ -0,0 +1,181 @@
+import os
+import shutil
+import logging
+import tempfile
+from dotenv import load_dotenv
+
+import numpy as np
+import torch
+from tqdm import tqdm
+from langchain_core.embeddings import Embeddings
+from sentence_transformers import SentenceTransformer
+
+load_dotenv()
+
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "128"))
+# "onnx" (INT8 ONNX Runtime), "torch" (sentence-transformers) or "auto" (onnx on CPU, torch on GPU)
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "auto").lower()
+ONNX_CACHE_DIR = os.getenv("ONNX_CACHE_DIR", "onnx_models")
+# File sentence-transformers' export_dynamic_quantized_onnx_model writes for the avx512_vnni config
+ONNX_QUANTIZED_FILE = "onnx/model_qint8_avx512_vnni.onnx"
+# Fuse the transformer's kernels with torch.compile (GPU only)
+EMBEDDING_COMPILE = os.getenv("EMBEDDING_COMPILE", "true").lower() in ("1", "true", "yes")
+# Sequence lengths compiled inputs are padded up to, so only a few CUDA graph shapes ever exist
+EMBEDDING_BUCKETS = [int(b) for b in os.getenv("EMBEDDING_BUCKETS", "64,128,256").split(",")]
+
+class SentenceTransformerEmbeddings(Embeddings):
+    """Sentence embeddings from SentenceTransformer.encode, which tokenizes, pools and normalizes in one call."""
+
+    def __init__(self, model_name, device, model_kwargs=None, batch_size=EMBEDDING_BATCH_SIZE, compile=False,
+                 backend="torch", warm_rows=None):
+        self.batch_size = batch_size
+        self.model = SentenceTransformer(model_name, device=device, model_kwargs=model_kwargs, backend=backend)
+        # Set once the model is compiled; encoding then pads every batch to one of these lengths
+        self.buckets = None
+        if compile:
+            self._compile(warm_rows or (batch_size,))
+
+    def _compile(self, warm_rows):
+        """Wraps the underlying HF model in torch.compile and pays the compile cost up front.
+
+        Only the batch sizes in warm_rows are compiled here; any other shape compiles on first use.
+        """
+        transformer = self.model._first_module()
+        eager_model = transformer.auto_model
+        try:
+            # Static shapes let "reduce-overhead" capture and replay one CUDA graph per bucket
+            transformer.auto_model = torch.compile(eager_model, mode="reduce-overhead", dynamic=False)
+            max_length = self.model.max_seq_length
+            self.buckets = sorted({b for b in EMBEDDING_BUCKETS if b < max_length} | {max_length})
+            # Room for one graph per bucket for full batches and one per bucket for single questions
+            torch._dynamo.config.recompile_limit = max(torch._dynamo.config.recompile_limit, 2 * len(self.buckets))
+            logging.info(f"Compiling the embedding model with torch.compile (buckets {self.buckets})...")
+            for bucket in self.buckets:
+                for rows in warm_rows:
+                    self._forward(["warm-up"], bucket, rows)
+        except Exception as e:
+            # e.g. no Triton on Windows; compilation only surfaces errors on the first call
+            logging.warning(f"torch.compile failed, running the embedding model eagerly: {e}")
+            transformer.auto_model = eager_model
+            self.buckets = None
+
+    def _encode_bucketed(self, texts, show_progress_bar=False):
+        """Encodes texts in fixed (rows, bucket) shapes so compiled CUDA graphs are replayed."""
+        if not texts:
+            return np.empty((0, self.model.get_sentence_embedding_dimension()), dtype=np.float32)
+
+        lengths = [len(ids) for ids in self.model.tokenizer(texts, truncation=True, max_length=self.buckets[-1])["input_ids"]]
+        order = sorted(range(len(texts)), key=lengths.__getitem__)
+        out = np.empty((len(texts), self.model.get_sentence_embedding_dimension()), dtype=np.float32)
+        # A single text (a question) has its own batch-of-one graphs instead of padding to batch_size
+        rows = 1 if len(texts) == 1 else self.batch_size
+        for start in tqdm(range(0, len(texts), self.batch_size), disable=not show_progress_bar):
+            idx = order[start:start + self.batch_size]
+            longest = max(lengths[i] for i in idx)
+            bucket = next(b for b in self.buckets if b >= longest)
+            out[idx] = self._forward([texts[i] for i in idx], bucket, rows)
+        return out
+
+    def _forward(self, texts, bucket, rows):
+        """Runs texts through the model as one (rows, bucket) batch and returns their embeddings."""
+        # Pad the batch dimension too, so a short final batch reuses the same graph
+        batch = texts + [""] * (rows - len(texts))
+        features = self.model.tokenizer(batch, padding="max_length", truncation=True, max_length=bucket, return_tensors="pt")
+        features = {k: v.to(self.model.device) for k, v in features.items()}
+        with torch.no_grad():
+            emb = self.model(features)["sentence_embedding"][:len(texts)]
+            emb = torch.nn.functional.normalize(emb.float(), dim=1)
+        return emb.cpu().numpy()
+
+    def encode(self, texts, show_progress_bar=False):
+        """Encodes texts into a matrix of L2-normalized embeddings."""
+        if self.buckets:
+            return self._encode_bucketed(texts, show_progress_bar=show_progress_bar)
+        return self.model.encode(
+            texts,
+            batch_size=self.batch_size,
+            show_progress_bar=show_progress_bar,
+            convert_to_numpy=True,
+            normalize_embeddings=True
+        )
+
+    def embed_documents(self, texts):
+        return self.encode(texts).tolist()
+
+    def embed_query(self, text):
+        return self.encode([text])[0].tolist()
+
+def _export_onnx(model_name, model_dir):
+    """Saves the model with a dynamically INT8-quantized ONNX export to model_dir."""
+    from sentence_transformers import export_dynamic_quantized_onnx_model
+
+    logging.info(f"Exporting '{model_name}' to ONNX and quantizing to INT8 in {model_dir}...")
+    os.makedirs(os.path.dirname(model_dir), exist_ok=True)
+    # Build the export beside its final location and move it in only once it is complete,
+    # so an interrupted run leaves nothing the cache check below would mistake for a model
+    tmp_dir = tempfile.mkdtemp(prefix=".export-", dir=os.path.dirname(model_dir))
+    try:
+        model = SentenceTransformer(model_name, device="cpu", backend="onnx")
+        # Keeps the model's own Pooling/Normalize modules and max_seq_length alongside the ONNX file
+        model.save_pretrained(tmp_dir)
+        export_dynamic_quantized_onnx_model(model, "avx512_vnni", tmp_dir)
+        if os.path.isdir(model_dir):
+            shutil.rmtree(model_dir)
+        os.replace(tmp_dir, model_dir)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+def load_onnx_embeddings(model_name, cache_dir=ONNX_CACHE_DIR):
+    """Loads the dynamically INT8-quantized ONNX export of the model, exporting it on first use."""
+    import onnxruntime as ort
+
+    model_dir = os.path.join(cache_dir, model_name.replace("/", "__"))
+    if not os.path.isfile(os.path.join(model_dir, ONNX_QUANTIZED_FILE)):
+        _export_onnx(model_name, model_dir)
+
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = os.cpu_count() or 1
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    return SentenceTransformerEmbeddings(
+        model_dir,
+        "cpu",
+        model_kwargs={"file_name": ONNX_QUANTIZED_FILE, "session_options": options},
+        backend="onnx"
+    )
+
+def get_device():
+    """Returns the torch device the embedding model should run on."""
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+def load_embeddings(model_name, warm_rows=None):
+    """Loads the embedding model with the configured backend.
+
+    warm_rows lists the batch sizes a compiled GPU model is warmed up for (default: full batches).
+    """
+    device = get_device()
+    backend = EMBEDDING_BACKEND
+    if backend == "auto":
+        backend = "torch" if device == "cuda" else "onnx"
+
+    if backend == "onnx":
+        try:
+            return load_onnx_embeddings(model_name)
+        except Exception as e:
+            # sentence-transformers reports a missing optimum/onnxruntime as a plain Exception
+            logging.warning(f"ONNX backend unavailable ({e}), falling back to sentence-transformers.")
+
+    model_kwargs = None
+    if device == "cuda":
+        # FP16 halves memory traffic and runs the linear layers on tensor cores
+        model_kwargs = {"torch_dtype": torch.float16}
+    else:
+        logging.info("CUDA not available, running the embedding model in FP32 on CPU.")
+
+    return SentenceTransformerEmbeddings(
+        model_name,
+        device,
+        model_kwargs=model_kwargs,
+        compile=EMBEDDING_COMPILE and device == "cuda",
+        warm_rows=warm_rows
+    )
@@ -1,31 +1,36 @@
 import os
+import re
+import mmap
 import logging
 import json
+import hashlib
+import sqlite3
+from contextlib import closing
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from dotenv import load_dotenv
 
-from langchain_community.vectorstores import Chroma
-from langchain_huggingface import HuggingFaceEmbeddings
+from langchain_core.documents import Document
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_community.document_loaders import DirectoryLoader
 from langchain_community.document_loaders import UnstructuredMarkdownLoader
 
 load_dotenv()
 
-logging.basicConfig(
-    level=logging.INFO,
-    format= '%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler("ingestion.log"),
-        logging.StreamHandler()
-    ]
-)
-
-
 SOURCE_DIRECTORY = os.getenv("SOURCE_DIRECTORY", "Documents")
 PERSIST_DIRECTORY = os.getenv("PERSIST_DIRECTORY", "db")
 EMBEDDING_MODEL_NAME = os.getenv("EMBEDDING_MODEL_NAME", "sentence-transformers/all-MiniLM-L6-v2")
+PROCESSED_FILES_DB = os.getenv("PROCESSED_FILES_DB", "processed_files.db")
+# Legacy JSON log, imported into the SQLite database on first run
 PROCESSED_FILES_JSON = os.getenv("PROCESSED_FILES_JSON", "processed_files.json")
+# Number of chunks embedded and inserted per round trip; keeps memory and HNSW updates bounded
+INSERT_BATCH_SIZE = int(os.getenv("INSERT_BATCH_SIZE", "512"))
+
+# Markdown with embedded HTML still goes through unstructured, which knows how to flatten it
+RAW_HTML_PATTERN = re.compile(rb"<(?:!doctype|html|body|div|table|iframe)\b", re.IGNORECASE)
+
+# Built once and shared by every ingest call
+TEXT_SPLITTER = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
 
 def load_processed_files(filepath):
     """Loads the dictionary of processed files and their modification times."""
@@ -35,106 +40,247 @@ def load_processed_files(filepath):
     except (FileNotFoundError, json.JSONDecodeError):
             # If the file doesn't exist or is empty/corrupt, start fresh
             return {}
-    
-def save_processed_files(filepath, processed_files):
-    """Saves the dictionary of processed files and their modification times."""
-    try:
-        with open(filepath, 'w') as f:
-            json.dump(processed_files, f, indent=4)
-    except IOError as e:
-        logging.error(f"IOError while saving processed files to {filepath}: {e}")
-    except Exception as e:
-        logging.error(f"Failed to save processed files to {filepath}: {e}")
 
-def should_process_file(filepath, processed_files):
-    """Determines if a file should be processed or not"""
-    try:
-        cm_time = os.path.getmtime(filepath)
-    except OSError:
-        return False
+class ProcessedDB:
+    """SQLite-backed log of processed files and their modification times."""
+
+    def __init__(self, filepath, legacy_json=None):
+        self.conn = sqlite3.connect(filepath)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS processed_files (path TEXT PRIMARY KEY, mtime REAL NOT NULL)"
+        )
+        if legacy_json:
+            self._migrate(legacy_json)
 
-    if filepath not in processed_files:
+    def _migrate(self, json_path):
+        """Imports the old JSON log into an empty database."""
+        if self.conn.execute("SELECT 1 FROM processed_files LIMIT 1").fetchone():
+            return
+        legacy = load_processed_files(json_path)
+        if legacy:
+            logging.info(f"Migrating {len(legacy)} processed file record(s) from {json_path}.")
+            self.upsert_many(legacy.items())
+            self.commit()
+
+    def get(self, filepath):
+        """Returns the recorded modification time for filepath, or None if it was never processed."""
+        row = self.conn.execute("SELECT mtime FROM processed_files WHERE path = ?", (filepath,)).fetchone()
+        return row[0] if row else None
+
+    def upsert_many(self, records):
+        """Records (path, mtime) pairs; call commit() to persist them."""
+        self.conn.executemany("INSERT OR REPLACE INTO processed_files (path, mtime) VALUES (?, ?)", records)
+
+    def commit(self):
+        try:
+            self.conn.commit()
+        except sqlite3.Error as e:
+            logging.error(f"Failed to save processed files: {e}")
+
+    def close(self):
+        self.conn.close()
+
+def should_process_file(filepath, mtime, processed_db):
+    """Determines if a file should be processed or not"""
+    recorded = processed_db.get(filepath)
+    if recorded is None:
         return True
-    if processed_files[filepath] < cm_time:
+    if recorded < mtime:
         return True
 
     return False
 
-def load_new_documents(source_path, processed_files):
+def _iter_md(root):
+    """Yields (path, mtime) for every markdown file under root, stat-ing each entry once."""
+    stack = [root]
+    while stack:
+        directory = stack.pop()
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        elif entry.name.endswith(".md"):
+                            yield entry.path, entry.stat().st_mtime
+                    except OSError:
+                        continue
+        except OSError as e:
+            logging.error(f"Failed to scan directory {directory}: {e}")
+
+def _load_one(filepath):
+    """Parses a single markdown file, returning (documents, error).
+
+    Lives at module level so worker processes can pickle it. Under the spawn start method
+    (Windows, macOS) workers re-import this module without the logging set up in main(),
+    so failures are reported back to the parent instead of logged here.
+    """
+    try:
+        with open(filepath, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return [Document(page_content="", metadata={"source": filepath})], None
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if RAW_HTML_PATTERN.search(mm):
+                    return UnstructuredMarkdownLoader(filepath).load(), None
+                # utf-8-sig drops a leading BOM so it never reaches the first chunk or its embedding
+                text = mm[:].decode("utf-8-sig", "replace")
+        return [Document(page_content=text, metadata={"source": filepath})], None
+    except Exception as e:
+        return None, str(e)
+
+def load_new_documents(source_path, processed_db):
     """Loads only new or modified markdown documents."""
     new_docs = []
     files_to_update_log = {}
 
     logging.info(f"Scanning directory: {source_path}")
-    for root, _, files in os.walk(source_path):
-        for filename in files:
-            if filename.endswith(".md"):
-                filepath = os.path.join(root, filename)
-                if should_process_file(filepath, processed_files):
-                    try:
-                        logging.info(f"Loading new/modified file: {filepath}")
-                        loader = UnstructuredMarkdownLoader(filepath)
-                        new_docs.extend(loader.load())
-                        files_to_update_log[filepath] = os.path.getmtime(filepath)
-                    except Exception as e:
-                        logging.error(f"Failed to load file {filepath}: {e}")
-    
+    changed = []
+    for filepath, mtime in _iter_md(source_path):
+        if should_process_file(filepath, mtime, processed_db):
+            logging.info(f"Loading new/modified file: {filepath}")
+            changed.append((filepath, mtime))
+    changed_paths = [filepath for filepath, _ in changed]
+
+    if not changed_paths:
+        return new_docs, files_to_update_log
+
+    # Markdown parsing is CPU-bound pure Python, so spread it across processes.
+    # Workers re-import this module, which is why the heavy imports live inside main().
+    max_workers = min(os.cpu_count() or 1, len(changed_paths))
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        results = executor.map(_load_one, changed_paths, chunksize=4)
+        for (filepath, mtime), (docs, error) in zip(changed, results):
+            if error is not None:
+                logging.error(f"Failed to load file {filepath}: {error}")
+                continue
+            new_docs.extend(docs)
+            files_to_update_log[filepath] = mtime
+
     return new_docs, files_to_update_log
 
 def split_documents(documents):
     """Splits documents into smaller chunks."""
     logging.info(f"Splitting {len(documents)} document(s) into chunks.")
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-    texts = text_splitter.split_documents(documents)
+    texts = TEXT_SPLITTER.split_documents(documents)
     logging.info(f"Created {len(texts)} new chunks.")
     return texts
 
-def update_vector_store(texts, embeddings_model, db_path):
-    """Creates or updates the vector store with new documents."""
+def chunk_id(source, content):
+    """Returns a stable id for a chunk derived from its source file and text."""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(source.encode("utf-8"))
+    # Separator so ("ab", "c") and ("a", "bc") can't produce the same id
+    digest.update(b"\0")
+    digest.update(content.encode("utf-8"))
+    return digest.hexdigest()
+
+def update_vector_store(texts, embeddings_model, collection):
+    """Creates or updates the vector store with new documents.
+
+    Returns the set of sources whose chunks are all in the collection, so a failure partway
+    through leaves the remaining files unrecorded and they are retried on the next run.
+    """
     if not texts:
         logging.info("No new texts to add to the vector store.")
-        return
+        return set()
+
+    # Chunks are keyed by source and content, so unchanged passages of an edited file keep their
+    # id, repeats within one file collapse, and a renamed or copied file gets entries of its own
+    unique = {}
+    for t in texts:
+        unique.setdefault(chunk_id(t.metadata.get('source', ''), t.page_content), t)
+
+    # Group similar lengths together so each encode batch pads as little as possible.
+    # Every batch carries its own ids and metadata, so the order never needs undoing.
+    chunks = sorted(unique.items(), key=lambda item: len(item[1].page_content))
+    sources = {t.metadata.get('source', '') for _, t in chunks}
 
+    start = 0
     try:
-        logging.info("Initializing vector store...")
-        vectordb = Chroma(
-            persist_directory=db_path,
-            embedding_function=embeddings_model
-        )
-        logging.info(f"Adding {len(texts)} new chunks to the vector store.")
-        vectordb.add_documents(texts)
-        logging.info("Successfully updated the vector store.")
+        logging.info(f"Upserting {len(chunks)} unique chunks into the vector store "
+                     f"(batches of {INSERT_BATCH_SIZE}, embedding batch size {embeddings_model.batch_size}).")
+        skipped = 0
+        for start in range(0, len(chunks), INSERT_BATCH_SIZE):
+            batch = chunks[start:start + INSERT_BATCH_SIZE]
+
+            # Only embed chunks the collection doesn't already hold
+            existing = set(collection.get(ids=[i for i, _ in batch], include=[])["ids"])
+            batch = [(i, t) for i, t in batch if i not in existing]
+            skipped += len(existing)
+            if not batch:
+                continue
+
+            ids = [i for i, _ in batch]
+            raw = [t.page_content for _, t in batch]
+            metas = [t.metadata for _, t in batch]
+
+            # Embed the whole batch in one call, then write it before moving on to the next
+            vecs = embeddings_model.encode(raw)
+            # Chroma persists every vector as float32, so int8/binary codes would save no space
+            # here; hand it the float32 matrix directly rather than boxing it into Python floats
+            collection.upsert(ids=ids, documents=raw, metadatas=metas, embeddings=vecs.astype("float32", copy=False))
+            logging.info(f"Processed {min(start + INSERT_BATCH_SIZE, len(chunks))}/{len(chunks)} chunks.")
+        logging.info(f"Successfully updated the vector store ({skipped} unchanged chunk(s) skipped).")
+        return sources
     except Exception as e:
         logging.error(f"Failed to update vector store: {e}")
+        # Chunks from the failed batch onwards were never written
+        unwritten = {t.metadata.get('source', '') for _, t in chunks[start:]}
+        return sources - unwritten
 
 # --- 4. MAIN ORCHESTRATOR ---
 
 def main():
     """Main function to run the ingestion pipeline."""
+    # Configured here rather than at import so parser worker processes don't reopen the log file
+    logging.basicConfig(
+        level=logging.INFO,
+        format= '%(asctime)s - %(levelname)s - %(message)s',
+        handlers=[
+            logging.FileHandler("ingestion.log"),
+            logging.StreamHandler()
+        ]
+    )
+
+    # Imported lazily: torch, sentence-transformers and chromadb are only needed in the parent
+    from embeddings import EMBEDDING_BATCH_SIZE, load_embeddings
+    from vector_store import get_collection
+
     logging.info("--- Starting ingestion process ---")
     
-    # Load the log of already processed files
-    processed_files = load_processed_files(PROCESSED_FILES_JSON)
-    
-    # Load only new or updated documents
-    new_documents, files_to_update = load_new_documents(SOURCE_DIRECTORY, processed_files)
+    # Open the log of already processed files; closed on every exit path, early returns included
+    with closing(ProcessedDB(PROCESSED_FILES_DB, legacy_json=PROCESSED_FILES_JSON)) as processed_db:
+        # Load only new or updated documents
+        new_documents, files_to_update = load_new_documents(SOURCE_DIRECTORY, processed_db)
 
-    if not new_documents:
-        logging.info("No new or modified documents to process. Exiting.")
-        return
+        if not new_documents:
+            logging.info("No new or modified documents to process. Exiting.")
+            return
         
-    # Split the new documents into chunks
-    chunks = split_documents(new_documents)
+        # Split the new documents into chunks
+        chunks = split_documents(new_documents)
     
-    # Initialize the embedding model
-    embeddings = HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL_NAME)
+        # Initialize the embedding model
+        embeddings = load_embeddings(EMBEDDING_MODEL_NAME, warm_rows=(EMBEDDING_BATCH_SIZE,))
     
-    # Update the vector store with the new chunks
-    update_vector_store(chunks, embeddings, PERSIST_DIRECTORY)
+        # Open the vector store once and update it with the new chunks
+        logging.info("Initializing vector store...")
+        try:
+            collection = get_collection(PERSIST_DIRECTORY)
+        except Exception as e:
+            logging.error(f"Failed to open vector store: {e}")
+            return
+        written = update_vector_store(chunks, embeddings, collection)
     
-    # Update and save the log of processed files
-    processed_files.update(files_to_update)
-    save_processed_files(PROCESSED_FILES_JSON, processed_files)
+        # Record only the files that changed in this run and made it into the vector store;
+        # files that produced no chunks have nothing to write and count as done
+        chunk_sources = {c.metadata.get('source', '') for c in chunks}
+        processed_db.upsert_many(
+            (path, mtime) for path, mtime in files_to_update.items()
+            if path in written or path not in chunk_sources
+        )
+        processed_db.commit()
     
     logging.info("--- Ingestion process completed successfully ---")
 
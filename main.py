@@ -1,12 +1,31 @@
 import os
+import json
+import asyncio
 import logging
 from dotenv import load_dotenv
 
+import numpy as np
+
 from langchain_community.vectorstores import Chroma
-from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_community.llms import Ollama
+from langchain_core.callbacks import StreamingStdOutCallbackHandler
 from langchain.prompts import PromptTemplate
-from langchain.chains import RetrievalQA
+from langchain.chains.combine_documents import create_stuff_documents_chain
+
+from embeddings import load_embeddings
+from vector_store import COLLECTION_METADATA, COLLECTION_NAME, get_client, get_collection
+
+try:
+    import uvloop
+except ImportError:
+    # uvloop isn't available on Windows; the default asyncio loop works the same, just slower
+    uvloop = None
+
+try:
+    from prompt_toolkit import PromptSession
+    from prompt_toolkit.history import FileHistory
+except ImportError:
+    PromptSession = None
 
 # --- 1. SETUP & CONFIGURATION ---
 
@@ -23,25 +42,158 @@ if not EMBEDDING_MODEL_NAME:
     logging.error("The EMBEDDING_MODEL_NAME environment variable is not set. Please set it in your .env file.")
     exit(1)
 OLLAMA_MODEL = os.getenv("OLLAMA_MODEL")
+# Layers to offload to the GPU. Unset lets Ollama fit as many as its VRAM estimate allows;
+# any explicit value overrides that estimate (999 forces every layer onto the GPU)
+OLLAMA_NUM_GPU = int(os.getenv("OLLAMA_NUM_GPU")) if os.getenv("OLLAMA_NUM_GPU") else None
+# Threads for the layers left on the CPU
+OLLAMA_NUM_THREAD = int(os.getenv("OLLAMA_NUM_THREAD", str(os.cpu_count() or 1)))
+OLLAMA_NUM_CTX = int(os.getenv("OLLAMA_NUM_CTX", "4096"))
+OLLAMA_TEMPERATURE = float(os.getenv("OLLAMA_TEMPERATURE", "0.0"))
+# Reuse Ollama's KV cache across queries: keep the model resident and present retrieved
+# chunks in a stable order so repeated contexts produce the same, already-prefilled prompt prefix.
+# Off by default: the stable order replaces relevance order in the prompt.
+PREFIX_CACHE = os.getenv("PREFIX_CACHE", "false").lower() in ("1", "true", "yes")
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+# Questions whose embeddings are at least this similar to a previous one reuse its answer
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95"))
+# Cache is persisted as <path>.npy (query embeddings) and <path>.json (answers + fingerprint)
+SEMANTIC_CACHE_PATH = os.getenv("SEMANTIC_CACHE_PATH", "qa_cache")
+# Questions are kept here across sessions (line editing and up-arrow recall need prompt_toolkit)
+QA_HISTORY_FILE = os.getenv("QA_HISTORY_FILE", ".qa_history")
+# MMR retrieval: pick k diverse chunks out of fetch_k nearest neighbours
+RETRIEVER_SEARCH_KWARGS = {
+    "k": int(os.getenv("RETRIEVER_K", "4")),
+    "fetch_k": int(os.getenv("RETRIEVER_FETCH_K", "20")),
+    "lambda_mult": float(os.getenv("RETRIEVER_LAMBDA_MULT", "0.5"))
+}
 
 # --- 2. CORE RAG COMPONENTS ---
 
-def create_rag_chain(retriever, llm, prompt):
-    """Creates the RAG chain using the specified retriever, LLM, and prompt."""
+class SemanticCache:
+    """Answers to previous questions, looked up by cosine similarity of the question embedding."""
+
+    def __init__(self, path, threshold, fingerprint, dim):
+        self.path = path
+        self.threshold = threshold
+        # Describes the model and index the answers came from; a mismatch means they may be stale
+        self.fingerprint = fingerprint
+        self.dim = dim
+        self.vecs = None
+        self.entries = []
+        self.load()
+
+    def load(self):
+        """Loads a previously saved cache, starting fresh if it is missing, stale or inconsistent."""
+        try:
+            vecs = np.load(f"{self.path}.npy")
+            with open(f"{self.path}.json", 'r') as f:
+                saved = json.load(f)
+        except (FileNotFoundError, ValueError, json.JSONDecodeError):
+            return
+        if not isinstance(saved, dict) or saved.get("fingerprint") != self.fingerprint:
+            logging.info("Documents or embedding model changed since the semantic cache was saved; discarding it.")
+            return
+        entries = saved.get("entries", [])
+        if vecs.ndim != 2 or vecs.shape[1] != self.dim or len(vecs) != len(entries):
+            logging.warning(f"Semantic cache at {self.path} doesn't match the embedding model; discarding it.")
+            return
+        self.vecs, self.entries = vecs.astype(np.float32), entries
+        logging.info(f"Loaded {len(entries)} cached answer(s) from {self.path}.")
+
+    def save(self):
+        """Persists the cache next to the application."""
+        if not self.entries:
+            return
+        try:
+            np.save(f"{self.path}.npy", self.vecs)
+            with open(f"{self.path}.json", 'w') as f:
+                json.dump({"fingerprint": self.fingerprint, "entries": self.entries}, f, indent=4)
+        except IOError as e:
+            logging.error(f"Failed to save semantic cache to {self.path}: {e}")
+
+    @staticmethod
+    def _normalize(query_vec):
+        query_vec = np.asarray(query_vec, dtype=np.float32)
+        return query_vec / max(np.linalg.norm(query_vec), 1e-12)
+
+    def lookup(self, query_vec):
+        """Returns the cached entry closest to query_vec if it clears the threshold, else None."""
+        if not self.entries:
+            return None
+        scores = self.vecs @ self._normalize(query_vec)
+        best = int(np.argmax(scores))
+        if scores[best] >= self.threshold:
+            return self.entries[best]
+        return None
+
+    def add(self, query_vec, entry):
+        """Stores entry under query_vec."""
+        query_vec = self._normalize(query_vec)[None, :]
+        self.vecs = query_vec if self.vecs is None else np.vstack([self.vecs, query_vec])
+        self.entries.append(entry)
+
+def retrieve(vectordb, query_vec):
+    """Returns the MMR-selected chunks for an already embedded question."""
+    docs = vectordb.max_marginal_relevance_search_by_vector(query_vec, **RETRIEVER_SEARCH_KWARGS)
+    if PREFIX_CACHE:
+        # A deterministic order makes a repeated chunk set produce a byte-identical prompt prefix
+        docs = sorted(docs, key=lambda doc: (doc.metadata.get('source', ''), doc.page_content))
+    return docs
+
+def create_rag_chain(llm, prompt):
+    """Creates the answer chain that stuffs the retrieved documents into the prompt."""
     try:
-        # Create a RetrievalQA chain, which is a standard way to build Q&A systems
-        qa_chain = RetrievalQA.from_chain_type(
-            llm=llm,
-            chain_type="stuff",  # "stuff" means all retrieved text is stuffed into the prompt
-            retriever=retriever,
-            return_source_documents=True,  # This allows us to see which documents were used
-            chain_type_kwargs={"prompt": prompt}
-        )
-        return qa_chain
+        # Retrieval happens in the query loop so the question is only embedded once
+        return create_stuff_documents_chain(llm, prompt)
     except Exception as e:
         logging.error(f"Failed to create RAG chain: {e}")
         return None
 
+async def query_loop(qa_chain, vectordb, embeddings, cache):
+    """Reads questions from the terminal and answers them until the user exits."""
+    session = PromptSession(history=FileHistory(QA_HISTORY_FILE)) if PromptSession else None
+    while True:
+        print()
+        try:
+            if session:
+                query = (await session.prompt_async("Question: ")).strip()
+            else:
+                query = input("Question: ").strip()
+        except EOFError:
+            query = "exit"
+        if query.lower() in ["exit", "quit"]:
+            print("Exiting application. Goodbye!")
+            break
+        if not query:
+            continue
+
+        # Reuse the answer to a near-identical earlier question if there is one
+        logging.info(f"Processing query: '{query}'")
+        # Called inline: aembed_query would hop to a worker thread, and the compiled GPU model's
+        # CUDA graphs are per thread, so they must be replayed on the thread that warmed them up
+        query_vec = embeddings.embed_query(query)
+        entry = cache.lookup(query_vec)
+
+        # Display the answer and its sources
+        print("\n--- Answer ---")
+        if entry is not None:
+            logging.info("Answer served from the semantic cache.")
+            print(entry["result"])
+        else:
+            # Retrieve with the embedding we already have, then answer; the LLM callback streams to stdout
+            docs = retrieve(vectordb, query_vec)
+            answer = await qa_chain.ainvoke({"context": docs, "question": query})
+            print()
+            entry = {
+                "result": answer,
+                # Keep the source file paths from the documents' metadata
+                "sources": [doc.metadata.get('source', 'Unknown source') for doc in docs]
+            }
+            cache.add(query_vec, entry)
+        print("\n--- Sources ---")
+        for source in entry["sources"]:
+            print(f"- {source}")
+
 # --- 3. MAIN APPLICATION ---
 
 def main():
@@ -50,15 +202,21 @@ def main():
 
     # Initialize embeddings and load the vector store from disk
     try:
-        embeddings = HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL_NAME)
+        # Only single questions are ever embedded here, so only batch-of-one graphs are warmed up
+        embeddings = load_embeddings(EMBEDDING_MODEL_NAME, warm_rows=(1,))
         
         # Check if the database directory exists before trying to load it
         if not os.path.isdir(PERSIST_DIRECTORY):
             logging.error(f"Database directory not found at '{PERSIST_DIRECTORY}'. Please run ingest.py first.")
             return
 
-        vectordb = Chroma(persist_directory=PERSIST_DIRECTORY, embedding_function=embeddings)
-        retriever = vectordb.as_retriever() # Create a retriever from the vector store
+        # Reuse the process-wide client instead of letting the wrapper open its own
+        vectordb = Chroma(
+            client=get_client(PERSIST_DIRECTORY),
+            collection_name=COLLECTION_NAME,
+            collection_metadata=COLLECTION_METADATA,
+            embedding_function=embeddings
+        )
         logging.info("Vector store loaded successfully.")
     except Exception as e:
         logging.error(f"Failed to load vector store: {e}")
@@ -66,7 +224,16 @@ def main():
 
     # Initialize the Ollama LLM
     try:
-        llm = Ollama(model=OLLAMA_MODEL)
+        # Print tokens as Ollama generates them instead of waiting for the full answer
+        llm = Ollama(
+            model=OLLAMA_MODEL,
+            num_gpu=OLLAMA_NUM_GPU,
+            num_thread=OLLAMA_NUM_THREAD,
+            num_ctx=OLLAMA_NUM_CTX,
+            temperature=OLLAMA_TEMPERATURE,
+            keep_alive=OLLAMA_KEEP_ALIVE if PREFIX_CACHE else None,
+            callbacks=[StreamingStdOutCallbackHandler()]
+        )
         logging.info(f"Ollama model '{OLLAMA_MODEL}' loaded successfully.")
     except Exception as e:
         logging.error(f"Failed to load Ollama model. Is Ollama running? Error: {e}")
@@ -87,40 +254,33 @@ def main():
     PROMPT = PromptTemplate(template=prompt_template, input_variables=["context", "question"])
 
     # Create the RAG chain
-    qa_chain = create_rag_chain(retriever, llm, PROMPT)
+    qa_chain = create_rag_chain(llm, PROMPT)
     if not qa_chain:
         logging.error("Exiting due to RAG chain creation failure.")
         return
 
+    # Cached answers are only valid for the same embedding model and the same indexed chunks
+    try:
+        fingerprint = {"model": EMBEDDING_MODEL_NAME, "chunks": get_collection(PERSIST_DIRECTORY).count()}
+        dim = len(embeddings.embed_query("dimension probe"))
+    except Exception as e:
+        logging.error(f"Failed to initialize the semantic cache: {e}")
+        return
+    cache = SemanticCache(SEMANTIC_CACHE_PATH, SEMANTIC_CACHE_THRESHOLD, fingerprint, dim)
+
     # Start the interactive query loop
     print("\n--- Personal Note Q&A ---")
     print("Ask questions based on your documents. Type 'exit' or 'quit' to end.")
     
+    run = uvloop.run if uvloop else asyncio.run
     try:
-        while True:
-            query = input("\nQuestion: ").strip()
-            if query.lower() in ["exit", "quit"]:
-                print("Exiting application. Goodbye!")
-                break
-            if not query:
-                continue
-
-            # Get the answer from the RAG chain
-            logging.info(f"Processing query: '{query}'")
-            result = qa_chain.invoke({"query": query})
-            
-            # Display the answer and its sources
-            print("\n--- Answer ---")
-            print(result["result"])
-            print("\n--- Sources ---")
-            for doc in result["source_documents"]:
-                # Print the source file path from the document's metadata
-                print(f"- {doc.metadata.get('source', 'Unknown source')}")
-
+        run(query_loop(qa_chain, vectordb, embeddings, cache))
     except KeyboardInterrupt:
         print("\nApplication interrupted by user. Exiting.")
     except Exception as e:
         logging.error(f"An error occurred during the query loop: {e}")
+    finally:
+        cache.save()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
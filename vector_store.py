@@ -0,0 +1,26 @@
+import os
+import functools
+from dotenv import load_dotenv
+
+import chromadb
+
+load_dotenv()
+
+# Collection name used by the LangChain Chroma wrapper, so existing databases keep working
+COLLECTION_NAME = os.getenv("COLLECTION_NAME", "langchain")
+# Only applied when the collection is first created; embeddings are normalized either way
+COLLECTION_METADATA = {"hnsw:space": "cosine"}
+
+@functools.lru_cache(maxsize=None)
+def get_client(path):
+    """Returns the process-wide Chroma client for path, so the index is only loaded once."""
+    return chromadb.PersistentClient(path=path)
+
+@functools.lru_cache(maxsize=None)
+def get_collection(path, name=COLLECTION_NAME):
+    """Returns the memoized collection handle stored under path."""
+    return get_client(path).get_or_create_collection(
+        name,
+        metadata=COLLECTION_METADATA,
+        embedding_function=None
+    )